@@ -21,24 +21,50 @@ from webob import Response
 
 #from pprint import pprint
 
+# Prefer orjson for its much faster loads/dumps - it also works directly on
+# the raw request bytes and emits bytes, so we skip a decode/encode pass.
 try:
-    import simplejson as json
-    from simplejson import JSONDecodeError
+    import orjson
+    JSONDecodeError = orjson.JSONDecodeError
+    def _loads(data):
+        return orjson.loads(data)
+    def _dumps(obj):
+        return orjson.dumps(obj)
 except ImportError:
-    import json
-    JSONDecodeError = ValueError
-
-import os, logging
+    try:
+        import simplejson as json
+        from simplejson import JSONDecodeError
+    except ImportError:
+        import json
+        JSONDecodeError = ValueError
+    def _loads(data):
+        return json.loads(data)
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+import inspect
+import os, sys, logging
+import re
+import shutil
+import tempfile
+import time
+import urllib2
 
 import anki.consts
 import anki.lang
+import anki.stats
 from anki.lang import _ as t
+from anki.notes import Note
 from anki.utils import intTime
 
 import AnkiServer
 
 __all__ = ['RestApp', 'RestHandlerBase', 'noReturnValue']
 
+# template for the response to handlers with no return value - built once and
+# shallow-copied per request instead of running Response.__init__ each time
+_EMPTY_RESPONSE = Response('', content_type='text/plain')
+
 def noReturnValue(func):
     func.hasReturnValue = False
     return func
@@ -69,17 +95,52 @@ class RestHandlerRequest(object):
     def __eq__(self, other):
         return self.app == other.app and self.data == other.data and self.ids == other.ids and self.session == other.session
 
+def _normalize_handler_types(handler_types):
+    """Normalizes a handler_types declaration into one frozenset per URL
+    position plus a flat tuple of all the type names."""
+
+    levels = tuple(
+        frozenset(t) if type(t) is list else frozenset([t])
+        for t in handler_types)
+    names = tuple(name for level in levels for name in level)
+    return (levels, names)
+
 class RestApp(object):
     """A WSGI app that implements RESTful operations on Collections, Decks and Cards."""
 
     # Defines not only the valid handler types, but their position in the URL string
     handler_types = ['collection', ['model', 'note', 'deck', 'card']]
 
+    # normalized once at class definition so neither __init__ nor the request
+    # path have to re-check for the list-of-types case
+    _handler_levels, _handler_type_names = _normalize_handler_types(handler_types)
+    _valid_handler_types = frozenset(_handler_type_names)
+
+    # a busy server sees the same handful of URL shapes over and over, so we
+    # memoize parsed paths up to this many entries
+    parse_path_cache_size = 4096
+
+    # bound on the collection path memo - collection_id comes from the URL,
+    # so the cache can't be allowed to grow with attacker-supplied ids
+    collection_path_cache_size = 1024
+
+    # name of the collection file inside each collection directory
+    collection_filename = 'collection.anki2'
+
     def __init__(self, data_root, **kw):
         from AnkiServer.threading import getCollectionManager
 
         self.data_root = os.path.abspath(data_root)
+        self._data_root_sep = self.data_root + os.sep
         self.allowed_hosts = kw.get('allowed_hosts', '*')
+        # normalize once: None means no filtering, otherwise an O(1)
+        # membership set that also supports a list of allowed addresses
+        if self.allowed_hosts == '*':
+            self._allowed_hosts = None
+        elif isinstance(self.allowed_hosts, basestring):
+            self._allowed_hosts = frozenset([self.allowed_hosts])
+        else:
+            self._allowed_hosts = frozenset(self.allowed_hosts)
         self.setup_new_collection = kw.get('setup_new_collection')
         self.hook_pre_execute = kw.get('hook_pre_execute')
         self.hook_post_execute = kw.get('hook_post_execute')
@@ -89,12 +150,9 @@ class RestApp(object):
         else:
             self.collection_manager = getCollectionManager()
 
-        self.handlers = {}
-        for type_list in self.handler_types:
-            if type(type_list) is not list:
-                type_list = [type_list]
-            for handler_type in type_list:
-                self.handlers[handler_type] = {}
+        # flat (type, name) -> (handler, hasReturnValue) table, so dispatch
+        # is a single dict lookup with no per-request hasattr probing
+        self._handler_table = {}
 
         if kw.get('use_default_handlers', True):
             self.add_handler_group('collection', CollectionHandler())
@@ -106,6 +164,12 @@ class RestApp(object):
         # hold per collection session data
         self.sessions = {}
 
+        # memo of raw path -> (type, name, ids) for _parsePath
+        self._parse_path_cache = {}
+
+        # memo of collection_id -> path for _getCollectionPath
+        self._collection_path_cache = {}
+
     def add_handler(self, type, name, handler):
         """Adds a callback handler for a type (collection, deck, card) with a unique name.
         
@@ -116,9 +180,13 @@ class RestApp(object):
          - 'handler' is a callable that takes (collection, data, ids).
         """
 
-        if self.handlers[type].has_key(name):
-            raise "Handler already for %(type)s/%(name)s exists!"
-        self.handlers[type][name] = handler
+        if type not in self._valid_handler_types:
+            raise KeyError(type)
+        if (type, name) in self._handler_table:
+            raise ValueError("Handler for %s/%s already exists" % (type, name))
+        # resolve the return-value flag once at registration time
+        hasReturnValue = getattr(handler, 'hasReturnValue', True)
+        self._handler_table[(type, name)] = (handler, hasReturnValue)
 
     def add_handler_group(self, type, group):
         """Adds several handlers for every public method on an object descended from RestHandlerBase.
@@ -126,12 +194,23 @@ class RestApp(object):
         This allows you to create a single class with several methods, so that you can quickly
         create a group of related handlers."""
 
-        import inspect
-        for name, method in inspect.getmembers(group, predicate=inspect.ismethod):
-            if not name.startswith('_'):
-                if hasattr(group, 'hasReturnValue') and not hasattr(method, 'hasReturnValue'):
-                    method = _RestHandlerWrapper(group.__class__.__name__ + '.' + name, method, group.hasReturnValue)
-                self.add_handler(type, name, method)
+        # scan the class dicts directly rather than inspect.getmembers, which
+        # dir()s the object and getattrs every attribute - including all the
+        # dunders inherited from object
+        names = set()
+        for klass in inspect.getmro(group.__class__):
+            if klass is not object:
+                names.update(vars(klass))
+
+        for name in sorted(names):
+            if name.startswith('_'):
+                continue
+            method = getattr(group, name)
+            if not callable(method):
+                continue
+            if hasattr(group, 'hasReturnValue') and not hasattr(method, 'hasReturnValue'):
+                method = _RestHandlerWrapper(group.__class__.__name__ + '.' + name, method, group.hasReturnValue)
+            self.add_handler(type, name, method)
 
     def execute_handler(self, type, name, col, req):
         """Executes the handler with the given type and name, passing in the col and req as arguments."""
@@ -143,16 +222,15 @@ class RestApp(object):
 
     def list_collections(self):
         """Returns an array of valid collection names in our self.data_path."""
-        return [x for x in os.listdir(self.data_root) if os.path.exists(os.path.join(self.data_root, x, 'collection.anki2'))]
+        return [x for x in os.listdir(self.data_root) if os.path.exists(os.path.join(self.data_root, x, self.collection_filename))]
 
     def _checkRequest(self, req):
         """Raises an exception if the request isn't allowed or valid for some reason."""
-        if self.allowed_hosts != '*':
-            try:
-                remote_addr = req.headers['X-Forwarded-For']
-            except KeyError:
-                remote_addr = req.remote_addr
-            if remote_addr != self.allowed_hosts:
+        if self._allowed_hosts is not None:
+            # the 'or' also covers an empty X-Forwarded-For header, which
+            # means no forwarding info
+            remote_addr = req.headers.get('X-Forwarded-For') or req.remote_addr
+            if remote_addr not in self._allowed_hosts:
                 raise HTTPForbidden()
         
         if req.path == '/':
@@ -167,46 +245,75 @@ class RestApp(object):
 
         Raises an HTTPNotFound exception if the path is invalid."""
 
+        # check the memo first - invalid paths are never cached, so a miss
+        # falls through to the real parser (which will raise HTTPNotFound)
+        try:
+            handler_type, name, ids = self._parse_path_cache[path]
+        except KeyError:
+            pass
+        else:
+            # hand out a fresh list so handlers can't mutate the cached one
+            return (handler_type, name, list(ids))
+
+        handler_type, name, ids = self._parsePathUncached(path)
+        if len(self._parse_path_cache) >= self.parse_path_cache_size:
+            self._parse_path_cache.clear()
+        self._parse_path_cache[path] = (handler_type, name, tuple(ids))
+
+        return (handler_type, name, ids)
+
+    def _parsePathUncached(self, path):
+        """The real parser behind _parsePath."""
+
         if path in ('', '/'):
             raise HTTPNotFound()
 
-        # split the URL into a list of parts
-        if path[0] == '/':
-            path = path[1:]
-        parts = path.split('/')
+        # split the URL into a list of parts - we walk it by index rather
+        # than popping from the head, which is O(n) per pop on a list
+        parts = path.lstrip('/').split('/')
+        count = len(parts)
+
+        # fast-path the overwhelmingly common URL shapes,
+        # /collection/<id>/<name> and /collection/<id>/<type>/<id>, with a
+        # couple of comparisons instead of the generic level walk below
+        if count in (3, 4) and parts[0] in self._handler_levels[0]:
+            if count == 3:
+                return (parts[0], parts[2], [parts[1]])
+            if len(self._handler_levels) > 1 and parts[2] in self._handler_levels[1]:
+                return (parts[2], 'index', [parts[1], parts[3]])
 
         # pull the type and context from the URL parts
         handler_type = None
         ids = []
-        for type_list in self.handler_types:
-            if len(parts) == 0:
+        pos = 0
+        for type_set in self._handler_levels:
+            if pos >= count:
                 break
 
-            # some URL positions can have multiple types
-            if type(type_list) is not list:
-                type_list = [type_list]
-
             # get the handler_type
-            if parts[0] not in type_list:
+            if parts[pos] not in type_set:
                 break
-            handler_type = parts.pop(0)
+            handler_type = parts[pos]
+            pos += 1
 
             # add the id to the id list
-            if len(parts) > 0:
-                ids.append(parts.pop(0))
+            if pos < count:
+                ids.append(parts[pos])
+                pos += 1
             # break if we don't have enough parts to make a new type/id pair
-            if len(parts) < 2:
+            if count - pos < 2:
                 break
 
         # sanity check to make sure the URL is valid
-        if len(parts) > 1 or len(ids) == 0:
+        remaining = count - pos
+        if remaining > 1 or len(ids) == 0:
             raise HTTPNotFound()
 
         # get the handler name
-        if len(parts) == 0:
+        if remaining == 0:
             name = 'index'
         else:
-            name = parts[0]
+            name = parts[pos]
 
         return (handler_type, name, ids)
 
@@ -215,11 +322,22 @@ class RestApp(object):
         
         Raises HTTPBadRequest if the collection_id is invalid."""
 
-        path = os.path.normpath(os.path.join(self.data_root, collection_id, 'collection.anki2'))
-        if path[0:len(self.data_root)] != self.data_root:
+        # the set of collection ids is small, so normalize each one only once
+        try:
+            return self._collection_path_cache[collection_id]
+        except KeyError:
+            pass
+
+        path = os.path.normpath(os.path.join(self.data_root, collection_id, self.collection_filename))
+        # compare against the root plus separator, so that a sibling like
+        # data_root + '_evil' can't slip past a plain prefix check
+        if not path.startswith(self._data_root_sep):
             # attempting to escape our data jail!
             raise HTTPBadRequest('"%s" is not a valid collection' % collection_id)
 
+        if len(self._collection_path_cache) >= self.collection_path_cache_size:
+            self._collection_path_cache.clear()
+        self._collection_path_cache[collection_id] = path
         return path
 
     def _getHandler(self, type, name):
@@ -228,18 +346,10 @@ class RestApp(object):
 
         Raises an HTTPNotFound exception if the handler doesn't exist."""
 
-        # get the handler function
         try:
-            handler = self.handlers[type][name]
+            return self._handler_table[(type, name)]
         except KeyError:
             raise HTTPNotFound()
-         
-        # get if we have a return value
-        hasReturnValue = True
-        if hasattr(handler, 'hasReturnValue'):
-            hasReturnValue = handler.hasReturnValue
-
-        return (handler, hasReturnValue)
 
     def _parseRequestBody(self, req):
         """Parses the request body (JSON) into a Python dict and returns it.
@@ -247,8 +357,8 @@ class RestApp(object):
         Raises an HTTPBadRequest exception if the request isn't valid JSON."""
         
         try:
-            data = json.loads(req.body)
-        except JSONDecodeError, e:
+            data = _loads(req.body)
+        except JSONDecodeError as e:
             logging.error(req.path+': Unable to parse JSON: '+str(e), exc_info=True)
             raise HTTPBadRequest()
 
@@ -256,8 +366,10 @@ class RestApp(object):
         if type(data) == list and len(data) == 0:
             data = {}
 
-        # make the keys into non-unicode strings
-        data = dict([(str(k), v) for k, v in data.items()])
+        # make the keys into non-unicode strings - only needed on Python 2,
+        # where JSON object keys come back as unicode
+        if sys.version_info[0] < 3:
+            data = {str(k): v for k, v in data.items()}
 
         return data
 
@@ -278,14 +390,14 @@ class RestApp(object):
         if req.path == '/':
             return Response('AnkiServer ' + str(AnkiServer.__version__), content_type='text/plain')
         if req.path == '/list_collections':
-            return Response(json.dumps(self.list_collections()), content_type='application/json')
+            body = _dumps(self.list_collections())
+            return Response(body=body, content_type='application/json', content_length=len(body))
 
         # parse the path
         type, name, ids = self._parsePath(req.path)
 
         # get the collection path
         collection_path = self._getCollectionPath(ids[0])
-        print collection_path
 
         # get the handler function
         handler, hasReturnValue = self._getHandler(type, name)
@@ -299,26 +411,29 @@ class RestApp(object):
         except KeyError:
             session = self.sessions[ids[0]] = {}
 
-        # debug
-        from pprint import pprint
-        pprint(data)
+        # logging.debug defers the formatting work unless DEBUG is enabled
+        logging.debug('%s: collection_path=%s data=%r', req.path, collection_path, data)
 
         # run it!
         try:
             col = self.collection_manager.get_collection(collection_path, self.setup_new_collection)
             handler_request = RestHandlerRequest(self, data, ids, session)
             output = col.execute(self._execute_handler, [handler_request, handler], {}, hasReturnValue)
-        except HTTPError, e:
+        except HTTPError:
             # we pass these on through!
             raise
-        except Exception, e:
-            logging.error(e)
-            return HTTPInternalServerError()
+        except Exception:
+            # logging.exception picks up the traceback from the current
+            # exception for free
+            logging.exception('%s/%s handler failed', type, name)
+            raise HTTPInternalServerError()
 
         if output is None:
-            return Response('', content_type='text/plain')
+            # copy the template so nothing downstream can mutate the shared one
+            return _EMPTY_RESPONSE.copy()
         else:
-            return Response(json.dumps(output), content_type='application/json')
+            body = _dumps(output)
+            return Response(body=body, content_type='application/json', content_length=len(body))
 
 class CollectionHandler(RestHandlerBase):
     """Default handler group for 'collection' type."""
@@ -345,7 +460,8 @@ class CollectionHandler(RestHandlerBase):
         ids = col.findNotes(query)
 
         if req.data.get('preload', False):
-            notes = [NoteHandler._serialize(col.getNote(id)) for id in ids]
+            model_cache = {}
+            notes = [NoteHandler._serialize(col.getNote(id), model_cache) for id in ids]
         else:
             notes = [{'id': id} for id in ids]
 
@@ -355,7 +471,7 @@ class CollectionHandler(RestHandlerBase):
         # TODO: use SQLAlchemy objects to do this
         sql = "SELECT n.id FROM notes AS n";
         args = []
-        if req.data.has_key('updated_since'):
+        if 'updated_since' in req.data:
             sql += ' WHERE n.mod > ?'
             args.append(req.data['updated_since'])
         sql += ' ORDER BY n.mod DESC'
@@ -363,7 +479,8 @@ class CollectionHandler(RestHandlerBase):
         ids = col.db.list(sql, *args)
 
         if req.data.get('preload', False):
-            notes = [NoteHandler._serialize(col.getNote(id)) for id in ids]
+            model_cache = {}
+            notes = [NoteHandler._serialize(col.getNote(id), model_cache) for id in ids]
         else:
             notes = [{'id': id} for id in ids]
 
@@ -371,8 +488,6 @@ class CollectionHandler(RestHandlerBase):
 
     @noReturnValue
     def add_note(self, col, req):
-        from anki.notes import Note
-
         # TODO: I think this would be better with 'model' for the name
         # and 'mid' for the model id.
         if type(req.data['model']) in (str, unicode):
@@ -384,7 +499,7 @@ class CollectionHandler(RestHandlerBase):
         for name, value in req.data['fields'].items():
             note[name] = value
 
-        if req.data.has_key('tags'):
+        if 'tags' in req.data:
             note.setTagsFromStr(req.data['tags'])
 
         col.addNote(note)
@@ -488,7 +603,7 @@ class CollectionHandler(RestHandlerBase):
         # TODO: use SQLAlchemy objects to do this
         sql = "SELECT c.id FROM notes AS n INNER JOIN cards AS c ON c.nid = n.id";
         args = []
-        if req.data.has_key('updated_since'):
+        if 'updated_since' in req.data:
             sql += ' WHERE n.mod > ?'
             args.append(req.data['updated_since'])
         sql += ' ORDER BY n.mod DESC'
@@ -507,7 +622,7 @@ class CollectionHandler(RestHandlerBase):
     #
 
     def reset_scheduler(self, col, req):
-        if req.data.has_key('deck'):
+        if 'deck' in req.data:
             deck = DeckHandler._get_deck(col, req.data['deck'])
             col.decks.select(deck['id'])
 
@@ -547,7 +662,7 @@ class CollectionHandler(RestHandlerBase):
         } for ease, label in enumerate(l, 1)]
 
     def next_card(self, col, req):
-        if req.data.has_key('deck'):
+        if 'deck' in req.data:
             deck = DeckHandler._get_deck(col, req.data['deck'])
             col.decks.select(deck['id'])
 
@@ -573,13 +688,11 @@ class CollectionHandler(RestHandlerBase):
     #       @noReturnValue, no error will be passed up. :-/ What to do?
     @noReturnValue
     def answer_card(self, col, req):
-        import time
-
         card_id = long(req.data['id'])
         ease = int(req.data['ease'])
 
         card = col.getCard(card_id)
-        if req.data.has_key('timerStarted'):
+        if 'timerStarted' in req.data:
             card.timerStarted = float(req.data['timerStarted'])
         else:
             card.timerStarted = time.time()
@@ -602,7 +715,7 @@ class CollectionHandler(RestHandlerBase):
         # TODO: Use sqlalchemy to build this query!
         sql = "SELECT r.cid, r.ease, r.id FROM revlog AS r INNER JOIN (SELECT cid, MAX(id) AS id FROM revlog GROUP BY cid) AS q ON r.cid = q.cid AND r.id = q.id"
         where = []
-        if req.data.has_key('ids'):
+        if 'ids' in req.data:
             where.append('ids IN (' + (','.join(["'%s'" % x for x in req.data['ids']])) + ')')
         if len(where) > 0:
             sql += ' WHERE ' + ' AND '.join(where)
@@ -619,7 +732,7 @@ class CollectionHandler(RestHandlerBase):
         # TODO: Use sqlalchemy to build this query!
         sql = "SELECT r.id, r.ease, r.cid, r.usn, r.ivl, r.lastIvl, r.factor, r.time, r.type FROM revlog AS r"
         args = []
-        if req.data.has_key('updated_since'):
+        if 'updated_since' in req.data:
             sql += ' WHERE r.id > ?'
             args.append(long(req.data['updated_since']) * 1000)
         sql += ' ORDER BY r.id DESC'
@@ -652,9 +765,6 @@ class CollectionHandler(RestHandlerBase):
     stats_reports_order = ['today', 'due', 'reps', 'interval', 'hourly', 'ease', 'card', 'footer']
 
     def stats_report(self, col, req):
-        import anki.stats
-        import re
-
         stats = anki.stats.CollectionStats(col)
         stats.width = int(req.data.get('width', 600))
         stats.height = int(req.data.get('height', 200))
@@ -670,7 +780,7 @@ class CollectionHandler(RestHandlerBase):
             html = ''
 
         for name in reports:
-            if not self.stats_reports.has_key(name):
+            if name not in self.stats_reports:
                 raise HTTPBadRequest("Unknown report name: %s" % name)
             func = getattr(stats, self.stats_reports[name])
 
@@ -706,48 +816,56 @@ class CollectionHandler(RestHandlerBase):
 class ImportExportHandler(RestHandlerBase):
     """Handler group for the 'collection' type, but it's not added by default."""
 
-    def _get_filedata(self, data):
-        import urllib2
+    def _write_filedata(self, data, fd):
+        """Writes the file data (either given inline or fetched from a URL) to the
+        given open file object. Downloads are streamed in chunks rather than
+        read into memory in one go."""
 
-        if data.has_key('data'):
-            return data['data']
+        if 'data' in data:
+            fd.write(data['data'])
+            return
 
-        fd = None
+        src = urllib2.urlopen(data['url'])
         try:
-            fd = urllib2.urlopen(data['url'])
-            filedata = fd.read()
+            shutil.copyfileobj(src, fd, 65536)
         finally:
-            if fd is not None:
-                fd.close()
+            src.close()
 
-        return filedata
+    # cache of filetype -> importer class, so the deferred import below only
+    # runs the first time each filetype is seen
+    _importer_class_cache = {}
 
     def _get_importer_class(self, data):
         filetype = data['filetype']
 
+        try:
+            return self._importer_class_cache[filetype]
+        except KeyError:
+            pass
+
+        # deferred so that importing this module doesn't pull in every
+        # anki.importing backend
         from AnkiServer.importer import get_importer_class
         importer_class = get_importer_class(filetype)
         if importer_class is None:
             raise HTTPBadRequest("Unknown filetype '%s'" % filetype)
 
+        self._importer_class_cache[filetype] = importer_class
         return importer_class
 
     def import_file(self, col, req):
         import AnkiServer.importer
-        import tempfile
 
         # get the importer class
         importer_class = self._get_importer_class(req.data)
 
-        # get the file data
-        filedata = self._get_filedata(req.data)
-
-        # write the file data to a temporary file
+        # stream the file data to a temporary file - opened binary, since
+        # some imports (like .apkg) are zip files
         try:
             path = None
-            with tempfile.NamedTemporaryFile('wt', delete=False) as fd:
+            with tempfile.NamedTemporaryFile('wb', delete=False) as fd:
                 path = fd.name
-                fd.write(filedata)
+                self._write_filedata(req.data, fd)
 
             AnkiServer.importer.import_file(importer_class, col, path)
         finally:
@@ -767,11 +885,22 @@ class NoteHandler(RestHandlerBase):
     """Default handler group for 'note' type."""
 
     @staticmethod
-    def _serialize(note):
+    def _serialize(note, model_cache=None):
+        """Serializes a note into a dict. When serializing a batch, pass the
+        same model_cache dict to every call so that note.model() is only
+        resolved once per model rather than once per note."""
+
+        if model_cache is None:
+            model = note.model()
+        else:
+            model = model_cache.get(note.mid)
+            if model is None:
+                model = model_cache[note.mid] = note.model()
+
         d = {
             'id': note.id,
             'guid': note.guid,
-            'model': note.model(),
+            'model': model,
             'mid': note.mid,
             'mod': note.mod,
             'scm': note.scm,
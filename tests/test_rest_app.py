@@ -86,7 +86,8 @@ class RestAppTest(unittest.TestCase):
         self.assertEqual(self.rest_app._getCollectionPath('user'), fullpath('user'))
 
         # These are dangerous - the user is trying to hack us!
-        dangerous = ['../user', '/etc/passwd', '/tmp/aBaBaB', '/root/.ssh/id_rsa']
+        dangerous = ['../user', '/etc/passwd', '/tmp/aBaBaB', '/root/.ssh/id_rsa',
+                     '../' + os.path.basename(self.temp_dir) + '_evil']
         for collection_id in dangerous:
             self.assertRaises(HTTPBadRequest, self.rest_app._getCollectionPath, collection_id)
 